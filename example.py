@@ -30,12 +30,10 @@ def main():
     if not path.is_char_device():
         raise ValueError("Device is not a character device: " + cmdline.device)
 
-    # Configure serial using external tool
-    import subprocess
+    # Configure serial for raw reading
     try:
-        subprocess.run(['stty', '-clocal', '-F', cmdline.device,
-                        'raw', '-echo', '-echoe', '-echok', '115200'])
-    except subprocess.CalledProcessError:
+        skin.configure_tty(cmdline.device, 115200, modem=True)
+    except OSError:
         print("Error configuring", cmdline.device, file=sys.stderr)
         sys.exit(1)
 
@@ -1,11 +1,11 @@
 #!/usr/bin/env python3
 
 import sys
-import subprocess
 import pathlib
 import numpy as np
 import threading
 
+import skin
 import rospy
 from sensor_msgs.msg import Joy
 
@@ -23,10 +23,17 @@ joint_range = {
     3: (-0.5, 0.5),  # upper_arm_roll
     4: (-0.3, 0.5),  # elbow_pitch
 }
-joint_min = { k: v[0] for k, v in joint_range.items() }
-joint_max = { k: v[1] for k, v in joint_range.items() }
 
-joints = np.zeros((max(joint_range.keys()),))
+# Joint limits as arrays, so a tick's updates are one np.clip; joints
+# without a range stay pinned at zero
+num_joints = max(joint_range.keys()) + 1
+joint_min = np.zeros((num_joints,))
+joint_max = np.zeros((num_joints,))
+for j, (lo, hi) in joint_range.items():
+    joint_min[j], joint_max[j] = lo, hi
+
+joints = np.zeros((num_joints,))
+joint_delta = np.zeros((num_joints,))
 
 # Increment maximum this much (radians) per ROS poll
 joint_increment = 0.002
@@ -40,14 +47,28 @@ class Flexiforce(threading.Thread):
         super().__init__(daemon=True)
 
     def run(self):
-        self.f = open(self.device, 'rt', encoding='ascii')
+        # Drain whatever has arrived into one reused buffer and keep only
+        # the latest complete line, rather than a read and parse per line
+        buf = bytearray(4096)
+        view = memoryview(buf)
+        end = 0
+        self.f = open(self.device, 'rb', buffering=0)
         while True:
-            try:
-                value_str = self.f.readline().rstrip('\n')
-                value = int(value_str)
-                self.value_ = value
-            except (ValueError, UnicodeDecodeError):
+            end += self.f.readinto(view[end:])
+            last = buf.rfind(b'\n', 0, end)
+            if last < 0:
+                if end == len(buf):
+                    end = 0  # no line in a full buffer, so drop it
                 continue
+            try:
+                # int() ignores the surrounding whitespace and carriage return
+                self.value_ = int(buf[buf.rfind(b'\n', 0, last) + 1:last])
+            except ValueError:
+                pass
+            # Carry the partial line after the last newline to the front
+            tail = end - last - 1
+            buf[:tail] = buf[last + 1:end]
+            end = tail
         self.f.close()
 
     @property
@@ -69,14 +90,10 @@ class Flexiforce(threading.Thread):
 
     def configure_device(self, baud):
         # Configure serial
-        def run_stty(*args):
-            result = subprocess.run(['stty', '-F', self.device] + list(args), check=True)
         status("Configuring", self.device, "with", baud, "baud")
         try:
-            run_stty('raw')
-            run_stty('-echo', '-echoe', '-echok')
-            run_stty(str(baud))
-        except subprocess.CalledProcessError:
+            skin.configure_tty(self.device, baud)
+        except OSError:
             fatal("Error configuring", self.device)
 
 def status(*args):
@@ -90,15 +107,21 @@ def increment_joint(joint, amount):
     """
     Increment the joint in positive direction, stopping at maximum
     """
-    global joints
-    joints[joint] = min(joints[joint] + amount, joint_max[joint])
+    joint_delta[joint] += amount
 
 def decrement_joint(joint, amount):
     """
     Decrement the joint in positive direction, stopping at minimum
     """
-    global joints
-    joints[joint] = max(joints[joint] - amount, joint_min[joint])
+    joint_delta[joint] -= amount
+
+def update_joints():
+    """
+    Apply this tick's increments to all joints, clipped to their ranges
+    """
+    np.add(joints, joint_delta, out=joints)
+    np.clip(joints, joint_min, joint_max, out=joints)
+    joint_delta[:] = 0
 
 
 def main():
@@ -110,11 +133,14 @@ def main():
     rate = rospy.Rate(ROS_rate)
     pub = rospy.Publisher('/joy', Joy, queue_size=1)
     joy = Joy()
+    # joints is only ever updated in place and publish() serializes the
+    # message before returning, so the array can be the message's axes
+    joy.axes = joints
 
     flexi.start()
     while not rospy.is_shutdown():
         increment_joint(1, flexi.value*joint_increment)
-        joy.axes = joints.tolist()
+        update_joints()
         pub.publish(joy)
         rate.sleep()
 
@@ -2,10 +2,17 @@
 
 import sys
 import argparse
+import importlib.util
+from concurrent.futures import ThreadPoolExecutor
 import numpy as np
 import pandas as pd
 import matplotlib.pyplot as plt
-from sklearn.linear_model import LinearRegression
+from matplotlib.collections import LineCollection
+from matplotlib.transforms import ScaledTranslation
+
+# pyarrow's CSV reader is multithreaded and releases the GIL, but is an
+# optional dependency.  pandas imports it itself when used
+csv_engine = 'pyarrow' if importlib.util.find_spec('pyarrow') else 'c'
 
 parser = argparse.ArgumentParser()
 parser.add_argument('infiles', nargs='+', help='input calibration test CSVs')
@@ -18,120 +25,153 @@ parser.add_argument('--model', choices=['linear', 'quadratic'], default='linear'
 cmdline = parser.parse_args()
 
 num_files = len(cmdline.infiles)
-
-dfs = []
-for num, infile in enumerate(cmdline.infiles):
-    df = pd.read_csv(infile).set_index(['patch', 'cell'])
-    df.columns = [col + str(num) for col in df.columns]
-    dfs.append(df)
-    
-df = pd.concat(dfs, axis=1)
-
-df['zero_avg'] = df[['baseline' + str(n) for n in range(num_files)]].mean(axis=1).round().astype(int)
-df['zero_std'] = df[['baseline' + str(n) for n in range(num_files)]].std(axis=1)
-
-for n in range(num_files):
-    df['delta' + str(n)] = (df['activated' + str(n)] - df['baseline' + str(n)])/df['force' + str(n)]
-
+force_cols = ['force%d' % n for n in range(num_files)]
+baseline_cols = ['baseline%d' % n for n in range(num_files)]
+activated_cols = ['activated%d' % n for n in range(num_files)]
+delta_cols = ['delta%d' % n for n in range(num_files)]
+
+# Every input has the same (patch, cell) rows and columns, so fill one
+# preallocated block per file rather than concatenating renamed frames
+def read_input(infile):
+    return pd.read_csv(infile, engine=csv_engine).set_index(['patch', 'cell'])
+
+with ThreadPoolExecutor() as pool:
+    inputs = list(pool.map(read_input, cmdline.infiles))
+first = inputs[0]
+base_cols = list(first.columns)
+num_cols = len(base_cols)
+data = np.empty((len(first), num_cols*num_files))
+for num, infile_df in enumerate(inputs):
+    data[:, num*num_cols:(num + 1)*num_cols] = infile_df.reindex(first.index)[base_cols].values
+
+df = pd.DataFrame(data, index=first.index,
+                  columns=[col + str(num) for num in range(num_files) for col in base_cols])
+
+# Pull the per-file columns out as arrays once for everything below
+force_mat = df[force_cols].values
+baseline_mat = df[baseline_cols].values
+activated_mat = df[activated_cols].values
+
+df['zero_avg'] = np.rint(baseline_mat.mean(axis=1)).astype(int)
+# Sample std, as pandas, which is NaN without a second file
+if num_files > 1:
+    df['zero_std'] = baseline_mat.std(axis=1, ddof=1)
+else:
+    df['zero_std'] = np.nan
+
+# All files' sensitivities in one array operation and one column insert
+df[delta_cols] = (activated_mat - baseline_mat)/force_mat
+
+
+# Axes are created without spines, rather than hiding them one by one
+# on each of the many fit figures
+no_spines = {
+    'axes.spines.left': False,
+    'axes.spines.right': False,
+    'axes.spines.top': False,
+    'axes.spines.bottom': False,
+}
 
 def plot_setup():
-    plt.figure(figsize=cmdline.figsize)
-    ax = plt.gca()
-    plt.subplots_adjust(left=0.15, right=0.95, top=0.93)
-    for spine in ax.spines:
-        ax.spines[spine].set_visible(False)
+    with plt.rc_context(no_spines):
+        fig, ax = plt.subplots(figsize=cmdline.figsize)
+    fig.subplots_adjust(left=0.15, right=0.95, top=0.93)
+    return fig, ax
 
 def plot_sensitivity(df):
-    plot_setup()
-    X = np.zeros((len(df), 1))
-    Y = np.zeros((len(df), 1), dtype=int)
-    for n in range(num_files):
-        x = df['force' + str(n)].values.reshape(-1, 1)
-        y = (df['activated' + str(n)] - df['baseline' + str(n)]).round().astype(int).values.reshape(-1, 1)
-        X = np.concatenate([X, x], axis=1)
-        Y = np.concatenate([Y, y], axis=1)
-    plt.plot(X.T, Y.T, '-o', label=df.index)
+    fig, ax = plot_setup()
+    # First column is the origin, then one column per input file
+    X = np.zeros((len(df), num_files + 1))
+    Y = np.zeros((len(df), num_files + 1), dtype=int)
+    X[:, 1:] = force_mat
+    Y[:, 1:] = (activated_mat - baseline_mat).round()
+    # One collection for all lines and one for all markers, rather than
+    # a Line2D per cell
+    colors = ['C%d' % (cell % 10) for cell in range(len(X))]
+    ax.add_collection(LineCollection(np.stack([X, Y], axis=2), colors=colors))
+    ax.scatter(X.ravel(), Y.ravel(), c=np.repeat(colors, X.shape[1]), s=36)
+    ax.autoscale_view()
     #plt.title("Sensitivity", fontsize=14)
+    # Label the end of each line with plain Text artists sharing one
+    # offset transform, rather than an Annotation per cell
+    offset = ax.transData + ScaledTranslation(5/72, 0, fig.dpi_scale_trans)
     for cell in range(len(X)):
-        #plt.text(X[cell, -1], Y[cell, -1], '  ' + str(cell))
-        plt.annotate('  ' + str(cell), (X[cell, -1], Y[cell, -1]), xytext=(5, 0), textcoords='offset points')
-    plt.xlabel("Indentation force (N)", fontsize=12)
-    plt.ylabel("Change in sensor value", fontsize=12)
-
-def save_fit(df, patch, cell, filebase=None):
-    linreg = LinearRegression()
-    def quadratic_fit(x, y):
-        x1 = x.reshape(-1, 1)
-        x2 = x1*x1
-        X = np.concatenate([x2, x1], axis=1)
-        res = linreg.fit(X, y)
-        samples_x = np.linspace(x.min(), x.max()).reshape(-1, 1)
-        # samples_y = res.coef_[0]*samples_x*samples_x + res.coef_[1]*samples_x + res.coef_[2]
-        # return samples_x, samples_y
-        samples_X = np.concatenate([samples_x*samples_x, samples_x], axis=1)
-        return samples_x, linreg.predict(samples_X), res
-
-    def linear_fit(x, y):
-        X = x.reshape(-1, 1)
-        res = linreg.fit(X, y)
-        samples_x = np.array([[x.min()], [x.max()]])
-        return samples_x, linreg.predict(samples_x), res
-
-    plot_setup()
+        ax.text(X[cell, -1], Y[cell, -1], '  ' + str(cell), transform=offset)
+    ax.set_xlabel("Indentation force (N)", fontsize=12)
+    ax.set_ylabel("Change in sensor value", fontsize=12)
+    return fig
+
+def fit_models(x, y):
+    """
+    Least squares fit of every row of y against the same row of x,
+    returning linear and quadratic coefficients [c0, c1, c2] per row
+    """
+    y_mean = y.mean(axis=1)
+    def lstsq(X):
+        # Same as LinearRegression: center, take the minimum-norm fit of
+        # the terms without the intercept, then recover the intercept.
+        # pinv is batched over the leading (cell) axis
+        X_mean = X.mean(axis=1)
+        coef = np.einsum('nij,nj->ni', np.linalg.pinv(X - X_mean[:, None]), y - y_mean[:, None])
+        return y_mean - np.einsum('ni,ni->n', X_mean, coef), coef
+    linear_models = np.zeros((len(x), 3))
+    linear_models[:, 0], linear_models[:, 1:2] = lstsq(x[:, :, None])
+    quadratic_models = np.empty((len(x), 3))
+    quadratic_models[:, 0], quadratic_models[:, 1:] = lstsq(np.stack([x, x*x], axis=2))
+    return linear_models, quadratic_models
+
+def save_fit(x, y, cell, linear_model, quadratic_model, filebase=None):
+    if not filebase:
+        return
+    fig, ax = plot_setup()
 
     # Note swapped axes from sensitivity
-    plt.xlabel("Change in sensor value", fontsize=12)
-    plt.ylabel("Indentation force (N)", fontsize=12)
-
-    row = df.loc[(patch, cell), :]
-    force = ['force%d' % n for n in range(num_files)]
-    baseline = ['baseline%d' % n for n in range(num_files)]
-    activated = ['activated%d' % n for n in range(num_files)]
-    num_points = len(force) + 1
-    x = np.zeros((num_points,))
-    y = np.zeros((num_points,))
-    x[1:] = row[activated].values - row[baseline].values
-    y[1:] = row[force].values
-    
+    ax.set_xlabel("Change in sensor value", fontsize=12)
+    ax.set_ylabel("Indentation force (N)", fontsize=12)
+
     color = 'C%d' % cell
-    X, Y, linear_res = linear_fit(x, y)
-    linear_model = [linear_res.intercept_, linear_res.coef_[0], 0]
-    plt.plot(X, Y, '--', label='linear', c=color, zorder=1)
-
-    X, Y, quadratic_res = quadratic_fit(x, y)
-    quadratic_model = [quadratic_res.intercept_, quadratic_res.coef_[1], quadratic_res.coef_[0]]
-    plt.plot(X, Y, '-', label='quadratic', c=color, zorder=2)
-
-    if cmdline.model == 'linear':
-        model = linear_model
-    elif cmdline.model == 'quadratic':
-        model = quadratic_model
-    else:
-        raise ValueError('Unknown model: ' + str(cmdline.type))
-
-    plt.scatter(x, y, marker='o', c=color, zorder=10)
-    plt.legend(frameon=False)
-    #result = stats.linregress(X.T, y)
-    plt.title('Cell %d' % cell)
-    if filebase:
-        filename = '%s-cell%s.%s' % (filebase, cell, cmdline.fmt)
-        print("Saving", filename)
-        plt.savefig(filename, fmt=cmdline.fmt, bbox_inches='tight')
+    X = np.array([x.min(), x.max()])
+    ax.plot(X, np.polynomial.polynomial.polyval(X, linear_model), '--', label='linear', c=color, zorder=1)
 
-    return model
+    X = np.linspace(x.min(), x.max())
+    ax.plot(X, np.polynomial.polynomial.polyval(X, quadratic_model), '-', label='quadratic', c=color, zorder=2)
+
+    ax.scatter(x, y, marker='o', c=color, zorder=10)
+    ax.legend(frameon=False)
+    #result = stats.linregress(X.T, y)
+    ax.set_title('Cell %d' % cell)
+    filename = '%s-cell%s.%s' % (filebase, cell, cmdline.fmt)
+    print("Saving", filename)
+    fig.savefig(filename, format=cmdline.fmt, bbox_inches='tight')
+    plt.close(fig)
 
-plot_sensitivity(df)
+sensitivity_fig = plot_sensitivity(df)
 if cmdline.plot:
     print("Saving", cmdline.plot)
-    plt.savefig(cmdline.plot, fmt=cmdline.fmt, bbox_inches='tight')
-
-rows = []
-for patch, cell in df.index.values:
-    model = save_fit(df, patch, cell, cmdline.fit)
-    baseline = df.loc[(patch, cell), 'baseline0'].astype(int)
-    rows.append([patch, cell, baseline] + model)
-    # if cell == 4:
-    #     breakpoint()
-profile = pd.DataFrame(rows, columns=['patch', 'cell', 'baseline', 'c0', 'c1', 'c2']).set_index(['patch', 'cell'])
-profile.to_csv(cmdline.output)
-        
+    sensitivity_fig.savefig(cmdline.plot, format=cmdline.fmt, bbox_inches='tight')
+
+baseline0 = df['baseline0'].values.astype(int)
+
+# Fit all cells at once; the origin is included as a point of every fit
+fit_x = np.zeros((len(df), num_files + 1))
+fit_y = np.zeros((len(df), num_files + 1))
+fit_x[:, 1:] = activated_mat - baseline_mat
+fit_y[:, 1:] = force_mat
+linear_models, quadratic_models = fit_models(fit_x, fit_y)
+models = {
+    'linear': linear_models,
+    'quadratic': quadratic_models,
+}[cmdline.model]
+
+for i, cell in enumerate(df.index.get_level_values('cell')):
+    save_fit(fit_x[i], fit_y[i], cell, linear_models[i], quadratic_models[i], cmdline.fit)
+
+# The profile is a plain numeric table, so write it straight from arrays
+profile = np.empty((len(df), 6))
+profile[:, 0] = df.index.get_level_values('patch')
+profile[:, 1] = df.index.get_level_values('cell')
+profile[:, 2] = baseline0
+profile[:, 3:] = models
+np.savetxt(cmdline.output, profile, delimiter=',', comments='',
+           header='patch,cell,baseline,c0,c1,c2',
+           fmt=['%d', '%d', '%d', '%.17g', '%.17g', '%.17g'])
@@ -2,7 +2,6 @@
 
 import sys
 import time
-import subprocess
 import pathlib
 import numpy as np
 from collections import OrderedDict
@@ -31,11 +30,18 @@ joint_range = {
     3: (-0.5, 0.5),  # upper_arm_roll
     4: (-0.3, 0.5),  # elbow_pitch
 }
-joint_direction = { j: 1 for j in joint_range.keys() }
-joint_min = { k: v[0] for k, v in joint_range.items() }
-joint_max = { k: v[1] for k, v in joint_range.items() }
 
-joints = np.zeros((max(joint_range.keys()),))
+# Joint limits as arrays, so a tick's updates are one np.clip; joints
+# without a range stay pinned at zero
+num_joints = max(joint_range.keys()) + 1
+joint_min = np.zeros((num_joints,))
+joint_max = np.zeros((num_joints,))
+for j, (lo, hi) in joint_range.items():
+    joint_min[j], joint_max[j] = lo, hi
+
+joints = np.zeros((num_joints,))
+joint_direction = np.ones((num_joints,))
+joint_delta = np.zeros((num_joints,))
 
 # Increment this much (radians) per ROS poll
 joint_increment = 0.0005
@@ -64,14 +70,10 @@ def setup_octocan():
         status("Found octocan device on", device)
 
     # Configure serial
-    def run_stty(*args):
-        result = subprocess.run(['stty', '-F', device] + list(args), check=True)
     status("Configuring", device)
     try:
-        run_stty('raw')
-        run_stty('-echo', '-echoe', '-echok')
-        run_stty(str(baud_rate))
-    except subprocess.CalledProcessError:
+        skin.configure_tty(device, baud_rate)
+    except OSError:
         fatal("Error configuring", device)
 
     # Setup sensor communication object
@@ -82,7 +84,16 @@ def setup_octocan():
     return sensor
 
 total_polls = 0
-values = np.zeros((num_cells,))
+
+def patch_offsets(sensor):
+    """
+    Index of each patch ID in layout order, and where each patch's cells
+    start within the whole-device state (which is in layout order)
+    """
+    layout = sensor.get_layout()
+    sizes = [len(cells) for cells in layout.values()]
+    starts = np.cumsum([0] + sizes[:-1])
+    return { patch: i for i, patch in enumerate(layout) }, starts
 
 def advance_joint(joint):
     """
@@ -98,15 +109,21 @@ def increment_joint(joint):
     """
     Increment the joint in positive direction, stopping at maximum
     """
-    global joints
-    joints[joint] = min(joints[joint] + joint_increment, joint_max[joint])
+    joint_delta[joint] += joint_increment
 
 def decrement_joint(joint):
     """
     Decrement the joint in positive direction, stopping at minimum
     """
-    global joints
-    joints[joint] = max(joints[joint] - joint_increment, joint_min[joint])
+    joint_delta[joint] -= joint_increment
+
+def update_joints():
+    """
+    Apply this tick's increments to all joints, clipped to their ranges
+    """
+    np.add(joints, joint_delta, out=joints)
+    np.clip(joints, joint_min, joint_max, out=joints)
+    joint_delta[:] = 0
 
 patch_control = OrderedDict({
     2: lambda: increment_joint(1),
@@ -120,14 +137,19 @@ def poll_octocan(sensor):
     global total_polls
     total_polls += 1
 
+    # One locked copy of every cell per poll, rather than one per patch
+    sensor.get_state_np(values)
+    # Sums and nonzero counts of all patches in one reduction each
+    sums = np.add.reduceat(values, patch_starts)
+    counts = np.add.reduceat(values != 0, patch_starts)
     for patch in patch_control:
-        for cell in range(sensor.cells):
-            values[cell] = sensor.get_expavg(patch, cell)
-        m = values[values != 0].mean()
+        i = patch_index[patch]
+        m = sums[i]/counts[i] if counts[i] else 0.0
         if m > threshold:
             patch_control[patch]()
         print(' %d: %10.0f %s' % (patch, m, 'O' if m > threshold else '.'), end='')
     print()
+    update_joints()
             
 
     # for patch in range(1, sensor.patches + 1): # patch IDs start at 1
@@ -154,16 +176,22 @@ def main():
     octocan.start()
     calibrate(octocan)
 
+    global values, patch_index, patch_starts
+    values = np.zeros((octocan.total_cells,))
+    patch_index, patch_starts = patch_offsets(octocan)
+
     # Set up ROS node
     rospy.init_node('octocan')
     rate = rospy.Rate(ROS_rate)
     pub = rospy.Publisher('/joy', Joy, queue_size=1)
     joy = Joy()
+    # joints is only ever updated in place and publish() serializes the
+    # message before returning, so the array can be the message's axes
+    joy.axes = joints
 
     # Publish data to ROS
     while not rospy.is_shutdown():
         poll_octocan(octocan)
-        joy.axes = joints.tolist()
         pub.publish(joy)
         rate.sleep()
 
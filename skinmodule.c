@@ -23,11 +23,40 @@ struct skin skin_default = {
 	.device = "/dev/ttyUSB0"
 };
 
+static PyObject *
+skin_configure_tty_py(PyObject *module, PyObject *args, PyObject *kw) {
+	DEBUGMSG("skin_configure_tty_py()");
+	static char *kwlist[] = {
+		"device",
+		"baud",
+		"modem",
+		NULL
+	};
+	const char *device;
+	int baud;
+	int modem = 0;
+	if ( !PyArg_ParseTupleAndKeywords(args, kw, "si|p", kwlist, &device, &baud, &modem) ) {
+		return NULL;
+	}
+	if ( !skin_configure_tty(device, baud, modem) ) {
+		PyErr_Format(PyExc_OSError, "Cannot configure %s at %d baud", device, baud);
+		return NULL;
+	}
+	Py_INCREF(Py_None);
+	return Py_None;
+}
+
+static PyMethodDef skin_functions[] = {
+	{ "configure_tty", (PyCFunction)skin_configure_tty_py, METH_VARARGS | METH_KEYWORDS, "Configures serial device for raw reading at a baud rate, optionally honoring modem control" },
+	{ NULL }
+};
+
 static struct PyModuleDef skin_module = {
 	PyModuleDef_HEAD_INIT,
 	.m_name = "skin",
 	.m_doc = "Skin sensor prototype interface module",
-	.m_size = -1
+	.m_size = -1,
+	.m_methods = skin_functions
 };
 
 //--------------------------------------------------------------------
@@ -37,7 +66,11 @@ Skin_dealloc(SkinObject *self) {
 	//Py_XDECREF(self->device);
 	if ( self ) {
 		skin_stop(&self->skin);
+		// The reader may be blocked in read() until the device sends
+		// more data, so let other Python threads run during the join
+		Py_BEGIN_ALLOW_THREADS
 		skin_wait(&self->skin);
+		Py_END_ALLOW_THREADS
 		skin_free(&self->skin);
 	}
 	Py_TYPE(self)->tp_free((PyObject *)self);
@@ -343,6 +376,87 @@ Skin_get_patch_state(SkinObject *self, PyObject *args) {
 	return ret;
 }
 
+static PyObject *
+Skin_get_patch_state_np(SkinObject *self, PyObject *args) {
+	int patch;
+	PyArrayObject *out;
+	if ( !self || !PyArg_ParseTuple(args, "iO!", &patch, &PyArray_Type, &out) ) {
+		WARNING("Skin_get_patch_state_np() could not parse arguments");
+		return NULL;
+	}
+	enum addr_check chk = address_check(&self->skin, patch, 0);
+	if ( chk == ADDR_PATCH_OOR ) {
+		PyErr_Format(PyExc_ValueError, "Patch number %d is out of range", patch);
+		return NULL;
+	} else if ( chk == ADDR_PATCH_INV ) {
+		PyErr_Format(PyExc_ValueError, "Patch number %d is invalid", patch);
+		return NULL;
+	}
+
+	const int num_cells = self->skin.layout.patch[self->skin.layout.patch_idx[patch]].num_cells;
+	const int type = PyArray_TYPE(out);
+	if ( (type != NPY_DOUBLE && type != NPY_FLOAT) || !PyArray_ISCARRAY(out) ) {
+		PyErr_SetString(PyExc_TypeError, "Output must be a writeable, C-contiguous float64 or float32 array");
+		return NULL;
+	}
+	if ( PyArray_SIZE(out) != num_cells ) {
+		PyErr_Format(PyExc_ValueError, "Output size %zd does not match %d cells of patch %d",
+					 (Py_ssize_t)PyArray_SIZE(out), num_cells, patch);
+		return NULL;
+	}
+	// float64 is filled in place; only float32 goes through a buffer
+	skincell_t buf[type == NPY_DOUBLE ? 1 : num_cells];
+	skincell_t *state = (type == NPY_DOUBLE) ? (skincell_t *)PyArray_DATA(out) : buf;
+	skin_get_patch_state(&self->skin, patch, state);
+	if ( type == NPY_FLOAT ) {
+		float *dst = (float *)PyArray_DATA(out);
+		for ( int c=0; c < num_cells; c++ ) {
+			dst[c] = state[c];
+		}
+	}
+
+	// Sum and count of nonzero cells, so callers need no mask for the mean
+	skincell_t sum = 0;
+	int nonzero = 0;
+	for ( int c=0; c < num_cells; c++ ) {
+		sum += state[c];
+		nonzero += (state[c] != 0);
+	}
+	return Py_BuildValue("(di)", sum, nonzero);
+}
+
+static PyObject *
+Skin_get_state_np(SkinObject *self, PyObject *args) {
+	PyArrayObject *out;
+	if ( !self || !PyArg_ParseTuple(args, "O!", &PyArray_Type, &out) ) {
+		WARNING("Skin_get_state_np() could not parse arguments");
+		return NULL;
+	}
+	const int total_cells = self->skin.total_cells;
+	const int type = PyArray_TYPE(out);
+	if ( (type != NPY_DOUBLE && type != NPY_FLOAT) || !PyArray_ISCARRAY(out) ) {
+		PyErr_SetString(PyExc_TypeError, "Output must be a writeable, C-contiguous float64 or float32 array");
+		return NULL;
+	}
+	if ( PyArray_SIZE(out) != total_cells ) {
+		PyErr_Format(PyExc_ValueError, "Output size %zd does not match %d total cells",
+					 (Py_ssize_t)PyArray_SIZE(out), total_cells);
+		return NULL;
+	}
+	if ( type == NPY_DOUBLE ) {
+		skin_get_state(&self->skin, (skincell_t *)PyArray_DATA(out));
+	} else {
+		skincell_t state[total_cells];
+		skin_get_state(&self->skin, state);
+		float *dst = (float *)PyArray_DATA(out);
+		for ( int c=0; c < total_cells; c++ ) {
+			dst[c] = state[c];
+		}
+	}
+	Py_INCREF(Py_None);
+	return Py_None;
+}
+
 static PyObject *
 Skin_get_patch_pressure(SkinObject *self, PyObject *args) {
 	//DEBUGMSG("Skin_get_patch_pressure()");
@@ -353,11 +467,7 @@ Skin_get_patch_pressure(SkinObject *self, PyObject *args) {
 		return NULL;
 	}
 	skin_get_patch_pressure(&self->skin, patch, &pressure);
-	PyObject *ret = PyList_New(3);
-	PyList_SetItem(ret, 0, Py_BuildValue("d", pressure.magnitude));
-	PyList_SetItem(ret, 1, Py_BuildValue("d", pressure.x));
-	PyList_SetItem(ret, 2, Py_BuildValue("d", pressure.y));
-	return ret;
+	return Py_BuildValue("[ddd]", pressure.magnitude, pressure.x, pressure.y);
 }
 
 static PyObject *
@@ -447,6 +557,8 @@ static PyMethodDef Skin_methods[] = {
 	{ "get_patch_profile", (PyCFunction)Skin_get_patch_profile, METH_VARARGS, "Gets calibration settings for a specific patch" },
 	//{ "get_state", (PyCFunction)Skin_get_state, METH_NOARGS, "Gets current state of all patches" },
 	{ "get_patch_state", (PyCFunction)Skin_get_patch_state, METH_VARARGS, "Gets current state of a specific patch" },
+	{ "get_patch_state_np", (PyCFunction)Skin_get_patch_state_np, METH_VARARGS, "Fills a preallocated float64 or float32 array with current state of a specific patch, returning (sum, nonzero count)" },
+	{ "get_state_np", (PyCFunction)Skin_get_state_np, METH_VARARGS, "Fills a preallocated float64 or float32 array with current state of all patches (patches and cells in order of get_layout)" },
 	{ "get_cell_ids", (PyCFunction)Skin_get_cell_ids, METH_VARARGS, "Gets cell ID numbers in a common order as other reporting methods (get_patch_state, etc.)" },
 	{ "get_patch_pressure", (PyCFunction)Skin_get_patch_pressure, METH_VARARGS, "Gets pressure for a single patch" },
 	{ "get_layout", (PyCFunction)Skin_get_layout, METH_NOARGS, "Gets skin device layout of patches and cells" },
@@ -3,6 +3,7 @@
 // Skin serial communication interface
 
 #define _XOPEN_SOURCE 700
+#define _DEFAULT_SOURCE  // cfmakeraw() and high baud rates
 
 #include <stdlib.h>
 #include <stdio.h>
@@ -11,6 +12,7 @@
 #include <sys/types.h>
 #include <sys/stat.h>
 #include <fcntl.h>
+#include <termios.h>
 #include <string.h>
 #include <errno.h>
 #include <pthread.h>
@@ -33,9 +35,9 @@
 
 #define RECORD_SIZE 5
 
-// Size of read buffer
-//#define BUFFER_SIZE 4096
-#define BUFFER_SIZE 128
+// Size of read buffer.  Reads return as soon as a record is available,
+// so a large buffer only lets one read() drain a backlog of records
+#define BUFFER_SIZE 4096
 
 // Magic number at start of each record
 #define RECORD_START 0x55
@@ -57,10 +59,11 @@ struct skin_record {
 // Get cell c from patch p of struct skin *s
 #define skin_cell(s, p, c) ( (s)->value[(s)->idx[(p)][(c)]] )
 
-static void
+// Same as alpha*value + (1 - alpha)*(*dst), in one multiply-add
+static inline void
 exp_avg(double *dst, double value, double alpha)
 {
-	*dst = alpha*value + (1 - alpha)*(*dst);
+	*dst += alpha*(value - *dst);
 }
 
 static void
@@ -104,15 +107,15 @@ get_record(struct skin_record *dst, uint8_t *src)
 	dst->value = convert_24to32(&src[2]);
 }
 
-// Wrapper for read(2)
+// Wrapper for read(2), blocks until at least min_count bytes arrive
+// but takes up to max_count bytes if they are already waiting
 static size_t
-read_bytes(struct skin *skin, void *dst, size_t count)
+read_bytes(struct skin *skin, void *dst, size_t min_count, size_t max_count)
 {
 	size_t pos = 0;
-	size_t read_count = 0;
 	ssize_t bytes_read;
 	do {
-		if ( (bytes_read = read(skin->device_fd, dst + pos, count - pos)) < 0 ) {
+		if ( (bytes_read = read(skin->device_fd, dst + pos, max_count - pos)) < 0 ) {
 			FATAL("Error reading from device:\n%s", strerror(errno));
 		}
 		if ( skin->debuglog ) {
@@ -124,13 +127,80 @@ read_bytes(struct skin *skin, void *dst, size_t count)
 			fprintf(skin->debuglog, "\n");
 		}
 		pos += bytes_read;
-		read_count += bytes_read;
-	} while ( pos < count );
-	return read_count;
-}
+	} while ( pos < min_count );
+	return pos;
+}
+
+// Baud rates supported by skin_configure_tty()
+static const struct {
+	int baud;
+	speed_t speed;
+} baud_rates[] = {
+	{ 9600, B9600 },
+	{ 19200, B19200 },
+	{ 38400, B38400 },
+	{ 57600, B57600 },
+	{ 115200, B115200 },
+	{ 230400, B230400 },
+	{ 460800, B460800 },
+	{ 500000, B500000 },
+	{ 921600, B921600 },
+	{ 1000000, B1000000 },
+	{ 1500000, B1500000 },
+	{ 2000000, B2000000 },
+	{ 3000000, B3000000 },
+	{ 4000000, B4000000 },
+	{ 0 }
+};
 
 //--------------------------------------------------------------------
 
+int
+skin_configure_tty(const char *device, int baud, int modem)
+{
+	DEBUGMSG("skin_configure_tty(\"%s\", %d, %d)", device, baud, modem);
+	speed_t speed = 0;
+	for ( int i=0; baud_rates[i].baud; i++ ) {
+		if ( baud_rates[i].baud == baud ) {
+			speed = baud_rates[i].speed;
+			break;
+		}
+	}
+	if ( !speed ) {
+		WARNING("Unsupported baud rate: %d", baud);
+		return 0;
+	}
+
+	int fd;
+	if ( (fd = open(device, O_RDWR | O_NOCTTY | O_NONBLOCK)) < 0 ) {
+		WARNING("Cannot open device: %s\n%s", device, strerror(errno));
+		return 0;
+	}
+
+	// Like `stty raw -echo -echoe -echok <baud>`, plus `-clocal` with
+	// modem.  Unlike stty raw, this also sets 8 data bits and no parity,
+	// and reads return as soon as a single byte is available
+	struct termios tio;
+	int ok = tcgetattr(fd, &tio) == 0;
+	if ( ok ) {
+		cfmakeraw(&tio);
+		tio.c_lflag &= ~(ECHOE | ECHOK);
+		if ( modem ) {
+			tio.c_cflag &= ~CLOCAL;
+		}
+		tio.c_cc[VMIN] = 1;
+		tio.c_cc[VTIME] = 0;
+		ok = cfsetispeed(&tio, speed) == 0
+			&& cfsetospeed(&tio, speed) == 0
+			&& tcsetattr(fd, TCSANOW, &tio) == 0;
+	}
+	if ( !ok ) {
+		WARNING("Cannot configure device: %s\n%s", device, strerror(errno));
+	}
+	close(fd);
+	return ok;
+}
+
 /* int */
 /* skin_init_octocan(struct skin *skin) */
 /* { */
@@ -177,23 +247,33 @@ skin_from_layout(struct skin *skin, const char *device, const char *lofile)
 
 	if ( !layout_read(&skin->layout, lofile) )
 		return 0;
+	for ( int p=0; p < skin->layout.num_patches; p++ ) {
+		const struct patch_layout *pl = &skin->layout.patch[p];
+		if ( pl->patch_id < 0 || pl->patch_id >= SKIN_MAX_ID
+			 || pl->max_cell_id >= SKIN_MAX_ID ) {
+			WARNING("Layout %s addresses beyond patch/cell ID %d", lofile, SKIN_MAX_ID - 1);
+			layout_free(&skin->layout);
+			return 0;
+		}
+	}
 
 	skin->num_patches = skin->layout.num_patches;
 	ALLOCN(skin->pressure, skin->num_patches);
 	skin->log = NULL;
 	skin->debuglog = NULL;
 
-	// Build indexing map (physical addr -> array index)
-	ALLOCN(skin->idx, skin->layout.max_patch_id);
+	// Build indexing map (physical addr -> array index), a fixed table
+	// since IDs are 4-bit, with sentinel value <0 for "unused"
+	for ( int p=0; p < SKIN_MAX_ID; p++ ) {
+		for ( int c=0; c < SKIN_MAX_ID; c++ ) {
+			skin->idx[p][c] = -1;
+		}
+	}
 	int count = 0;
 	for ( int p=0; p < skin->num_patches; p++ ) {
 		const struct patch_layout *pl = &skin->layout.patch[p];
-		ALLOCN(skin->idx[pl->patch_id], pl->max_cell_id);
 
-		// Sentinel value <0 for "unused"
-		for ( int i=0; i < pl->max_cell_id; i++ ) {
-			skin->idx[pl->patch_id][i] = -1;
-		}
+		// Cells of a patch are contiguous in value[], in layout order
 		for ( int i=0; i < pl->num_cells; i++ ) {
 			skin->idx[pl->patch_id][pl->cell_id[i]] = count++;
 		}
@@ -222,10 +302,6 @@ skin_free(struct skin *skin)
 	if ( !skin ) {
 		return;
 	}
-	for ( int p=0; p < skin->num_patches; p++ ) {
-		free(skin->idx[skin->layout.patch[p].patch_id]);
-	}
-	free(skin->idx);
 	free(skin->value);
 	free(skin->pressure);
 	profile_free(&skin->profile);
@@ -300,9 +376,9 @@ skin_cell_write(struct skin *skin, int patch, int cell, int32_t rawvalue)
 		//pthread_mutex_unlock(&skin->lock);
 	} else {
 		skincell_t value = scale_value(skin, patch, cell, rawvalue);
+		skincell_t *dst = &skin_cell(skin, patch, cell);
 		pthread_mutex_lock(&skin->lock);
-		//skin_cell(skin, patch, cell) = skin->alpha*value + (1 - skin->alpha)*skin_cell(skin, patch, cell);
-		exp_avg(&skin_cell(skin, patch, cell), value, skin->alpha);
+		exp_avg(dst, value, skin->alpha);
 		pthread_mutex_unlock(&skin->lock);
 	}
 }
@@ -331,16 +407,24 @@ skin_reader(void *args)
 	/* write_code(skin, CALIB_CODE); */
 	/* sleep(1); */
 	write_code(skin, START_CODE);
-	skin->total_bytes += read_bytes(skin, buffer, BUFFER_SIZE);
+
+	// Parsing a record peeks at the start of the next one, so only
+	// block until that many bytes are buffered and parse whatever has
+	// arrived rather than waiting for a full buffer
+	const int min_bytes = RECORD_SIZE + 1;
+	int end = read_bytes(skin, buffer, min_bytes, BUFFER_SIZE);
+	skin->total_bytes += end;
 
 	int advanced = 0;
 	for ( int pos=0; !skin->shutdown; ) {
-		if ( pos + RECORD_SIZE > BUFFER_SIZE ) {
-			// If out of space, rewind the tape and refill it
+		if ( pos + min_bytes > end ) {
+			// If out of data, rewind the tape and top it up
 			EVENT(skin, "rewind", "%d", pos);
-			const int scrap = BUFFER_SIZE - pos;
+			const int scrap = end - pos;
 			memmove(buffer, buffer + pos, scrap);
-			skin->total_bytes += read_bytes(skin, buffer + scrap, BUFFER_SIZE - scrap);
+			const int count = read_bytes(skin, buffer + scrap, min_bytes - scrap, BUFFER_SIZE - scrap);
+			skin->total_bytes += count;
+			end = scrap + count;
 			pos = 0;
 		}
 
@@ -594,23 +678,22 @@ skin_get_calibration(struct skin *skin, int patch, int cell)
 	return ret;
 }
 
-/* int */
-/* skin_get_state(struct skin *skin, skincell_t *dst) */
-/* { */
-/* 	pthread_mutex_lock(&skin->lock); */
-/* 	memcpy(dst, skin->value, skin->total_cells*sizeof(*skin->value)); */
-/* 	pthread_mutex_unlock(&skin->lock); */
-/* 	return skin->num_patches; */
-/* } */
+int
+skin_get_state(struct skin *skin, skincell_t *dst)
+{
+	pthread_mutex_lock(&skin->lock);
+	memcpy(dst, skin->value, skin->total_cells*sizeof(*skin->value));
+	pthread_mutex_unlock(&skin->lock);
+	return skin->num_patches;
+}
 
 int
 skin_get_patch_state(struct skin *skin, int patch, skincell_t *dst)
 {
 	const struct patch_layout *pl = skin_get_patch_layout(skin, patch);
+	const skincell_t *src = &skin_cell(skin, patch, pl->cell_id[0]);
 	pthread_mutex_lock(&skin->lock);
-	for ( int c=0; c < pl->num_cells; c++ ) {
-		dst[c] = skin_cell(skin, patch, pl->cell_id[c]);
-	}
+	memcpy(dst, src, pl->num_cells*sizeof(*dst));
 	pthread_mutex_unlock(&skin->lock);
 	return 1;
 }
@@ -624,25 +707,22 @@ skin_get_patch_pressure(struct skin *skin, int patch, struct skin_pressure *dst)
 	struct skin_pressure p = {};
 
 	skin_get_patch_state(skin, patch, state);
-	skincell_t sum = 0;
+
+	// Clamped values weight the fixed cell positions in the same pass,
+	// leaving a single normalization at the end
+	skincell_t sum = 0, sum_x = 0, sum_y = 0;
 	for ( int c=0; c < num_cells; c++ ) {
-		if ( state[c] > SKIN_PRESSURE_MAX ) {
-			state[c] = 1;
-		} else if ( state[c] < 0 ) {
-			state[c] = 0;
-		} else {
-			state[c] /= SKIN_PRESSURE_MAX;
-		}
-		sum += state[c];
+		const skincell_t w = state[c] > SKIN_PRESSURE_MAX ? SKIN_PRESSURE_MAX
+			: (state[c] < 0 ? 0 : state[c]);
+		sum += w;
+		sum_x += w*pl->x[c];
+		sum_y += w*pl->y[c];
 	}
 
 	if ( sum != 0 ) {
-		for ( int c=0; c < num_cells; c++ ) {
-			const double norm = state[c]/sum;
-			p.x += norm*pl->x[c];
-			p.y += norm*pl->y[c];
-		}
-		p.magnitude = sum*SKIN_PRESSURE_MAX;
+		p.magnitude = sum;
+		p.x = sum_x/sum;
+		p.y = sum_y/sum;
 		p.x = p.x < pl->xmin ? pl->xmin : (p.x > pl->xmax ? pl->xmax : p.x);
 		p.y = p.y < pl->ymin ? pl->ymin : (p.y > pl->ymax ? pl->ymax : p.y);
 	}
@@ -660,11 +740,12 @@ skincell_t
 skin_get_patch_mean(struct skin *skin, int patch)
 {
 	const struct patch_layout *pl = skin_get_patch_layout(skin, patch);
+	const skincell_t *src = &skin_cell(skin, patch, pl->cell_id[0]);
 	skincell_t sum = 0;
 
 	pthread_mutex_lock(&skin->lock);
 	for ( int c=0; c < pl->num_cells; c++ ) {
-		sum += skin_cell(skin, patch, pl->cell_id[c]);
+		sum += src[c];
 	}
 	pthread_mutex_unlock(&skin->lock);
 
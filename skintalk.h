@@ -15,6 +15,9 @@ typedef double skincell_t;
 
 #define SKIN_PRESSURE_MAX 1000
 
+// Patch and cell IDs are 4-bit fields in device records
+#define SKIN_MAX_ID 16
+
 struct skin_pressure {
 	double magnitude;
 	double x, y;
@@ -39,7 +42,7 @@ struct skin {
 	struct layout layout;    // layout of cells in patches
 
 	skincell_t *value;       // array of cell values
-	int **idx;               // map of [patch][cell] IDs to value[] index
+	int idx[SKIN_MAX_ID][SKIN_MAX_ID];  // map of [patch][cell] IDs to value[] index
 
 	double alpha;            // alpha for exponential averaging of values
 	double pressure_alpha;   // alpha for smoothing presure calculations
@@ -70,6 +73,10 @@ struct skin {
 	int last_cell;  // last cell id read
 };
 
+// Configures serial device for raw binary reading at baud rate.  If
+// modem is nonzero, also clears CLOCAL to honor modem control lines
+int skin_configure_tty(const char *device, int baud, int modem);
+
 //int skin_init_octocan(struct skin *skin);
 //int skin_init(struct skin *skin, const char *device, int patches, int cells);
 int skin_from_layout(struct skin *skin, const char *device, const char *lofile);
@@ -100,7 +107,8 @@ struct patch_profile *skin_get_patch_profile(struct skin *skin, int patch);
 
 skincell_t skin_get_calibration(struct skin *skin, int patch, int cell);
 
-//int skin_get_state(struct skin *skin, skincell_t *dst);
+// Copies every cell value, patches and cells in layout order
+int skin_get_state(struct skin *skin, skincell_t *dst);
 //int skin_get_pressure(struct skin *skin, struct skin_pressure *dst);
 
 int skin_get_patch_state(struct skin *skin, int patch, skincell_t *dst);
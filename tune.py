@@ -7,18 +7,14 @@
 
 import sys
 import pathlib
-import subprocess
 import time
-import datetime
 import argparse
-import threading
 import numpy as np
-import pandas as pd
 import matplotlib as mpl
 import matplotlib.pyplot as plt
 import matplotlib.animation as animation
 
-from matplotlib.patches import Polygon
+from matplotlib.patches import Polygon, Rectangle
 from matplotlib.widgets import Button, TextBox
 from scipy.spatial import Voronoi
 
@@ -26,14 +22,22 @@ import skin
 
 mpl.rcParams['toolbar'] = 'None'
 
+# Noisy traces are mostly segments that differ by under a pixel, which
+# path simplification can drop before rasterizing
+mpl.rcParams['path.simplify'] = True
+mpl.rcParams['path.simplify_threshold'] = 1.0
+mpl.rcParams['agg.path.chunksize'] = 10000
+
 # List of devices to try (if not given on cmdline)
 devices = ['/dev/ttyUSB0']
 baud_rate = 115200  # default, overrideable at cmdline
 
-shutdown = False
 total_frames = 0
 
 CIRCLE_SCALE = 2
+
+# Cell line limits shrink to fit their history only every this many frames
+RESCALE_FRAMES = 10
 CIRCLE_PROPS = {
     'edgecolor': 'cadetblue',
     'facecolor': None,
@@ -65,15 +69,30 @@ cell_lbl_props = {
     #'labelpad': 10,
 }
 
+def unroll(history, pos, out):
+    """
+    Unroll ring buffer history (along its last axis), oldest first from
+    pos, into out
+    """
+    split = history.shape[-1] - pos
+    out[..., :split] = history[..., pos:]
+    out[..., split:] = history[..., :pos]
+
 class CellLine:
-    def __init__(self, sensor, ax, label, initial_value, color='k', **kwargs):
+    def __init__(self, sensor, ax, label, initial_value, color='k', values=None, ydata=None, **kwargs):
         self.ax = ax
         ax.axis('off') # gives 10x frame rate!!!
-        ax.set_xlim(0, cmdline.history)
-        self.values = np.full(cmdline.history, initial_value)
+        # values and ydata may be rows of arrays shared with other lines,
+        # which the owner then fills for all lines at once
+        self.values = np.empty(cmdline.history) if values is None else values
+        self.values[:] = initial_value
+        self.ydata = np.empty_like(self.values) if ydata is None else ydata
+        self.ydata[:] = initial_value
         self.sensor = sensor
         self.pos = 0
         self.automode = True
+        self.stale_frames = 0
+        self.slack = 0
         self.editor = None
         self.target = sensor.get_target_pressure()
         
@@ -82,43 +101,105 @@ class CellLine:
 
         textcolor = 'dimgray'
         margin = 0.05
-        self.cell_text = plt.figtext(x - margin, y + 0.5*height, label, ha='center', va='center', fontsize=12, color=textcolor)
+        self.cell_text = ax.figure.text(x - margin, y + 0.5*height, label, ha='center', va='center', fontsize=12, color=textcolor)
         self.upper_value = initial_value
         self.lower_value = initial_value
         upper_lbl = '%.0f' % initial_value
         lower_lbl = '%.0f' % initial_value
         hmargin = 0.01
         vmargin = 0.005
-        self.upper_text = plt.figtext(x + width + hmargin, y + height - vmargin, upper_lbl, ha='left', va='top', color=textcolor)
-        self.lower_text = plt.figtext(x + width + hmargin, y + vmargin, lower_lbl, ha='left', va='bottom', color=textcolor)
+
+        # Stretch the axes over the label column so the changing labels
+        # fall inside its bbox and are redrawn when blitting, keeping the
+        # line itself where it was
+        label_width = 0.2
+        ax.set_position([x, y, width + label_width, height])
+        ax.set_xlim(0, cmdline.history*(width + label_width)/width)
+        lx = (width + hmargin)/(width + label_width)
+        self.upper_text = ax.text(lx, 1 - vmargin/height, upper_lbl, transform=ax.transAxes, ha='left', va='top', color=textcolor)
+        self.lower_text = ax.text(lx, vmargin/height, lower_lbl, transform=ax.transAxes, ha='left', va='bottom', color=textcolor)
+
+        # A history much longer than the line is wide in pixels is drawn
+        # as the min and max of each pixel column's worth of samples,
+        # which looks the same with far fewer points
+        history = len(self.values)
+        line_px = max(1, int(ax.bbox.width*width/(width + label_width)))
+        self.bucket = history//line_px if history > 2*line_px else 1
+        if self.bucket > 1:
+            buckets = history//self.bucket
+            start = history - buckets*self.bucket
+            self.shown = np.full(2*buckets, initial_value)
+            self.line.set_data(np.repeat(start + self.bucket*np.arange(buckets), 2), self.shown)
 
     def add(self, value):
+        self.push(value)
+        unroll(self.values, self.pos, self.ydata)
+        self.redraw()
+
+    def push(self, value):
         self.values[self.pos] = value
         self.pos += 1
         self.pos %= len(self.values)
-        self.update_minmax()
-        xdata, _ = self.line.get_data()
-        ydata = np.hstack([self.values[self.pos:], self.values[:self.pos]])
-        if not self.automode:
-            ydata = np.clip(ydata, 0, self.target)
-        self.line.set_data(xdata, ydata)
+        self.notify(value)
+
+    def notify(self, value):
         if self.editor:
             self.editor.update(value)
 
+    def redraw(self, vmin=None, vmax=None):
+        """
+        Redraw the unrolled ydata with the history's min and max, if
+        already known
+        """
+        self.update_minmax(vmin, vmax)
+        ydata = self.ydata
+        if not self.automode:
+            np.clip(ydata, 0, self.target, out=ydata)
+        if self.bucket > 1:
+            buckets = len(self.shown)//2
+            columns = ydata[len(ydata) - buckets*self.bucket:].reshape(buckets, self.bucket)
+            columns.min(axis=1, out=self.shown[0::2])
+            columns.max(axis=1, out=self.shown[1::2])
+            ydata = self.shown
+        self.line.set_ydata(ydata)
+
     def fmt(self, value):
         return '%.0f' % value
         
-    def update_minmax(self):
+    def update_minmax(self, vmin=None, vmax=None):
         if self.automode:
-            vmin = self.values.min()
-            vmax = self.values.max()
+            if vmin is None:
+                vmin = self.values.min()
+            if vmax is None:
+                vmax = self.values.max()
+            # Widen once the line nears the axes edge, but otherwise only
+            # rescale every few frames
+            self.stale_frames += 1
+            inside = vmax <= self.upper_value + self.slack and vmin >= self.lower_value - self.slack
+            if inside and self.stale_frames < RESCALE_FRAMES:
+                return
+            self.stale_frames = 0
+            # Limits only need touching when the extremes actually move
+            if vmax == self.upper_value and vmin == self.lower_value:
+                return
             if vmax != self.upper_value:
                 self.upper_value = vmax
                 self.upper_text.set_text(self.fmt(vmax))
             if vmin != self.lower_value:
                 self.lower_value = vmin
                 self.lower_text.set_text(self.fmt(vmin))
-            self.ax.set_ylim(vmin, vmax)
+            self.set_ylim(vmin, vmax)
+
+    def set_ylim(self, low, high):
+        # A little headroom keeps the line off the axes edge, where the
+        # blitted background would not cover it on the next frame
+        pad = 0.1*(high - low)
+        self.ax.set_ylim(low - pad, high + pad)
+        # Values may wander into half of that before the limits must widen
+        self.slack = 0.5*pad
+
+    def artists(self):
+        return self.line, self.upper_text, self.lower_text
 
     def install(self, ed):
         self.editor = ed
@@ -128,6 +209,7 @@ class CellLine:
             
     def set_auto_mode(self):
         self.automode = True
+        self.stale_frames = RESCALE_FRAMES
         self.update_minmax()
     
     def set_target_mode(self):
@@ -138,7 +220,7 @@ class CellLine:
         self.upper_value = high
         self.lower_text.set_text(self.fmt(low))
         self.upper_text.set_text(self.fmt(high))
-        self.ax.set_ylim(low, high)
+        self.set_ylim(low, high)
 
 
 class AvgLine(CellLine):
@@ -146,7 +228,9 @@ class AvgLine(CellLine):
         super().__init__(sensor, ax, label, initial_value, color, **kwargs)
         
     def add(self, values):
-        super().add(self.sensor.get_patch_mean(cmdline.patch))
+        # Mean of the state already fetched for this frame, rather than
+        # asking the sensor again
+        super().add(values.mean())
 
 class PressureLine(CellLine):
     def __init__(self, sensor, ax, label, initial_value, color='cadetblue', **kwargs):
@@ -239,13 +323,11 @@ def setup_octocan():
         print("Found octocan device on", device)
 
     # Configure serial
-    def run_stty(*args):
-        return subprocess.run(['stty', '-clocal', '-F', device] + list(args), check=True)
     if not cmdline.noconfigure:
         print("Configuring", device)
         try:
-            run_stty('raw', '-echo', '-echoe', '-echok', str(cmdline.baud))
-        except subprocess.CalledProcessError:
+            skin.configure_tty(device, cmdline.baud, modem=True)
+        except OSError:
             print("Error configuring", device, file=sys.stderr)
             sys.exit(1)
 
@@ -259,48 +341,47 @@ def setup_octocan():
         sensor.log(cmdline.log)
     return sensor
 
-def stats_updater(sensor, view, sleep=2):
-    global shutdown, total_frames
-    bytes_before = sensor.total_bytes
-    records_before = sensor.total_records
-    before = datetime.datetime.now()
+def stats_updater(sensor):
+    """
+    Returns a callback that prints reader and plotter rates since its
+    previous call, for a GUI timer on the plotting thread
+    """
     num_cells = sensor.total_cells
-    frames_before = total_frames
     def dropped_records():
         tally = sensor.get_record_tally()
         return tally['patch_outofrange'] + tally['cell_outofrange']
-    dropped_before = dropped_records()
-    misalign_before = sensor.misalignments
-    while not shutdown:
-        time.sleep(sleep)
-        now = datetime.datetime.now()
-        bytes_now = sensor.total_bytes
-        records_now = sensor.total_records
-        frames_now = total_frames
-        dropped_now = dropped_records()
-        misalign_now = sensor.misalignments
-
-        time_delta = (now - before).total_seconds()
-        bytes_rate = (bytes_now - bytes_before)/time_delta
-        records_rate = (records_now - records_before)/time_delta
-        total_Hz = records_rate/num_cells
-        frame_rate = (frames_now - frames_before)/time_delta
+    before = {
+        'time': time.monotonic(),
+        'bytes': sensor.total_bytes,
+        'records': sensor.total_records,
+        'frames': total_frames,
+        'dropped': dropped_records(),
+        'misalign': sensor.misalignments,
+    }
+
+    def update():
+        now = {
+            'time': time.monotonic(),
+            'bytes': sensor.total_bytes,
+            'records': sensor.total_records,
+            'frames': total_frames,
+            'dropped': dropped_records(),
+            'misalign': sensor.misalignments,
+        }
+        delta = { k: now[k] - before[k] for k in now }
+        time_delta = delta['time']
+        records_rate = delta['records']/time_delta
 
         print("reader: %.2f KB/s (%d misaligns)  %.0f records/s (%d dropped)  %.1f Hz   plotter: %.1f fps" % (
-            bytes_rate/1024,
-            misalign_now - misalign_before,
+            delta['bytes']/time_delta/1024,
+            delta['misalign'],
             records_rate,
-            dropped_now - dropped_before,
-            total_Hz,
-            frame_rate
+            delta['dropped'],
+            records_rate/num_cells,
+            delta['frames']/time_delta
         ))
-
-        bytes_before = bytes_now
-        records_before = records_now
-        frames_before = frames_now
-        dropped_before = dropped_now
-        misalign_before = misalign_now
-        before = now
+        before.update(now)
+    return update
 
 def tessellate(sensor, patch):
     layout = sensor.get_layout()
@@ -349,6 +430,33 @@ def toggle_mode(cell_lines):
         else:
             cl.set_target_mode()
 
+class LutColors:
+    """
+    Colors of values from a table of a colormap's colors, binned over
+    the range of norm the same way the colormap does, into reused arrays.
+    NaN takes the colormap's bad color
+    """
+    def __init__(self, cmap, norm, size):
+        # The bad color sits just past the colormap's own colors
+        self.lut = np.vstack((cmap(np.arange(cmap.N)), cmap.get_bad()))
+        self.top = cmap.N - 1
+        self.offset = norm.vmin
+        self.scale = cmap.N/(norm.vmax - norm.vmin)
+        self.scaled = np.empty(size)
+        self.bad = np.empty(size, dtype=bool)
+        self.idx = np.empty(size, dtype=np.intp)
+        self.colors = np.empty((size, 4))
+
+    def __call__(self, values):
+        np.subtract(values, self.offset, out=self.scaled)
+        np.multiply(self.scaled, self.scale, out=self.scaled)
+        # Out of range bins take the end colors
+        np.clip(self.scaled, 0, self.top, out=self.scaled)
+        np.isnan(self.scaled, out=self.bad)
+        np.copyto(self.scaled, self.top + 1, where=self.bad)
+        np.copyto(self.idx, self.scaled, casting='unsafe')
+        return np.take(self.lut, self.idx, axis=0, out=self.colors)
+
 def anim_init(sensor, patch):
     patch_layout = sensor.get_layout()[patch]
     num_cells = len(patch_layout)
@@ -372,7 +480,10 @@ def anim_init(sensor, patch):
     tare_ax = fig.add_subplot(gs[-button_rows, 0])
     tare_button = Button(tare_ax, 'Tare')
     tare_button.label.set_fontsize(14)
-    tare_button.on_clicked(lambda _: calibrate(sensor))
+    tare_timer = fig.canvas.new_timer(interval=4000)
+    tare_timer.single_shot = True
+    tare_timer.add_callback(tare_finish, sensor)
+    tare_button.on_clicked(lambda _: tare(sensor, tare_timer))
 
     heat.axis('off')
     heat.set_xlim(*lims[:,0])
@@ -390,20 +501,27 @@ def anim_init(sensor, patch):
         [1.00, 'black'],
     ])
 
-    cell_ids = sorted(list(cell_to_poly.keys()))
+    # Resolve cell IDs to polygons once, in the same layout order as the
+    # state array that colors them every frame
+    cell_ids = sensor.get_cell_ids(patch)
     polys = [ cell_to_poly[i] for i in cell_ids ]
-    collection = mpl.collections.PatchCollection(polys, cmap=cmap, norm=norm)
+    collection = mpl.collections.PatchCollection(polys)
 
-    state = sensor.get_patch_state(patch)
-    collection.set_array(state)
+    # Color cells by indexing a table of the colormap's colors, rather
+    # than running the norm and colormap at every draw
+    heat_colors = LutColors(cmap, norm, num_cells)
+    state = np.array(sensor.get_patch_state(patch))
+    collection.set_facecolor(heat_colors(state))
     heat.add_collection(collection)
 
+    cell_id_texts = []
     for cell_id in patch_layout:
         pos = patch_layout[cell_id]
-        heat.text(pos[0], pos[1], str(cell_id), ha='center', va='center', color='gray', fontsize=14)
+        cell_id_texts.append(heat.text(pos[0], pos[1], str(cell_id), ha='center', va='center', color='gray', fontsize=14))
 
-    cell_labels = sensor.get_cell_ids(patch)
-    cell_lines = [ CellLine(sensor, ax, cell_labels[i], state[i]) for i, ax in enumerate(cell_axs) ]
+    cell_history = np.empty((num_cells, cmdline.history))
+    cell_ydata = np.empty_like(cell_history)
+    cell_lines = [ CellLine(sensor, ax, cell_ids[i], state[i], values=cell_history[i], ydata=cell_ydata[i]) for i, ax in enumerate(cell_axs) ]
     avg_line = AvgLine(sensor, avg_ax, 'x\u0305', np.mean(state))
     avg_line.target = sensor.get_target_pressure()
 
@@ -417,6 +535,12 @@ def anim_init(sensor, patch):
     mode_button.on_clicked(lambda _, cl=cell_lines + [avg_line]: toggle_mode(cl))
 
     circle = heat.scatter([0], [0], s=1, zorder=10, edgecolor='cadetblue', facecolor=None, lw=2, alpha=0.8)
+
+    # Blitting restores whole pixels inside the axes, so keep the heat
+    # map's animated artists just inside its edges
+    inset = Rectangle((0.01, 0.01), 0.98, 0.98, transform=heat.transAxes)
+    collection.set_clip_path(inset)
+    circle.set_clip_path(inset)
     
     global args
     args = {
@@ -425,42 +549,89 @@ def anim_init(sensor, patch):
         'heat': heat,
         'cell_axs': cell_axs,
         'cell_lines': cell_lines,
-        'cmap': cmap,
+        'cell_history': cell_history,
+        'cell_ydata': cell_ydata,
+        'cell_pos': 0,
+        'last_records': -1,
+        'state': state,
+        'heat_colors': heat_colors,
         'collection': collection,
         'cell_to_poly': cell_to_poly,
         'avg_line': avg_line,
         'tare_button': tare_button,
+        'tare_timer': tare_timer,
         'mode_button': mode_button,
         'circle': circle,
         'pressure_line': pressure_line,
+        'cell_id_texts': cell_id_texts,
     }
+
+    # Leave everything that changes per frame out of the full redraws, so
+    # the background saved for blitting is clean.  The same list is
+    # returned by every frame, so build it once
+    args['artists'] = anim_artists()
+    for artist in args['artists']:
+        artist.set_animated(True)
     return fig
 
+def anim_artists():
+    """
+    Artists redrawn on every frame when blitting
+    """
+    # Cell IDs sit above the heat map, so they are redrawn over it too
+    artists = [args['collection'], args['circle']] + args['cell_id_texts']
+    for cl in args['cell_lines'] + [args['avg_line'], args['pressure_line']]:
+        artists.extend(cl.artists())
+    return artists
+
 def anim_update(frame):
     global args
     patch = args['patch']
     sensor = args['sensor']
 
-    state = sensor.get_patch_state(patch)
-    args['collection'].set_array(state)
-
+    # Nothing new to compute until the reader has parsed more records.
+    # Still hand back the animated artists unchanged, since a full redraw
+    # (resize, expose) leaves them out and only the blit paints them back
+    records = sensor.total_records
+    if records == args['last_records']:
+        return args['artists']
+    args['last_records'] = records
+
+    # Fill the reused array in place, then color all cells in one lookup
+    state = args['state']
+    sensor.get_patch_state_np(patch, state)
+    args['collection'].set_facecolor(args['heat_colors'](state))
+
+    # Cell lines share one history and ring position, so record, unroll
+    # and reduce every cell at once
+    cell_history = args['cell_history']
+    pos = args['cell_pos']
+    cell_history[:, pos] = state
+    pos = args['cell_pos'] = (pos + 1) % cmdline.history
+    unroll(cell_history, pos, args['cell_ydata'])
+    vmins = cell_history.min(axis=1)
+    vmaxs = cell_history.max(axis=1)
     for i, cl in enumerate(args['cell_lines']):
-        cl.add(state[i])
+        cl.notify(state[i])
+        cl.redraw(vmins[i], vmaxs[i])
     args['avg_line'].add(state)
 
     magnitude, x, y = sensor.get_patch_pressure(patch)
     args['pressure_line'].add(magnitude)
     
+    # Hide the one persistent marker rather than shrinking it to nothing,
+    # and only move and resize it while it is shown
     circle = args['circle']
-    circle.set_offsets([x, y])
-    if magnitude < 10:
-        circle.set_sizes([0.001])
-    else:
-        circle.set_sizes([max(1, 2*magnitude)])
+    circle.set_visible(magnitude >= 10)
+    if circle.get_visible():
+        circle.set_offsets((x, y))
+        circle.set_sizes((max(1, 2*magnitude),))
 
     global total_frames
     total_frames += 1
 
+    return args['artists']
+
 def calibrate(sensor, keep=True, show=True):
     sensor.calibrate_start()
     print('Baseline calibration... DO NOT TOUCH!')
@@ -468,6 +639,26 @@ def calibrate(sensor, keep=True, show=True):
     sensor.calibrate_stop()
     print('Baseline calibration finished')
 
+tare_pending = False
+def tare(sensor, timer):
+    """
+    Baseline calibration from the Tare button, finished by a single-shot
+    GUI timer so plotting keeps running meanwhile
+    """
+    global tare_pending
+    if tare_pending:
+        return
+    tare_pending = True
+    sensor.calibrate_start()
+    print('Baseline calibration... DO NOT TOUCH!')
+    timer.start()
+
+def tare_finish(sensor):
+    global tare_pending
+    sensor.calibrate_stop()
+    print('Baseline calibration finished')
+    tare_pending = False
+
 def save_profile(sensor):
     print('Saving calibration profile to', cmdline.profile)
     sensor.save_profile(cmdline.profile)
@@ -502,16 +693,12 @@ def tune_table(sensor, cell_lines, patch):
 
 
 def main():
-    global shutdown
     parse_cmdline()
     sensor = setup_octocan()
 
     if cmdline.debug:
         sensor.debuglog(cmdline.debug)
 
-    stats_thread = threading.Thread(target=stats_updater, args=(sensor, None))
-    stats_thread.start()
-
     print(sensor.get_target_pressure())
     sensor.start()
     if not cmdline.nocalibrate:
@@ -519,14 +706,19 @@ def main():
 
     global args
     fig = anim_init(sensor, cmdline.patch)
-    anim = animation.FuncAnimation(fig, cache_frame_data=False, func=anim_update, interval=cmdline.delay)
+    anim = animation.FuncAnimation(fig, cache_frame_data=False, save_count=0, func=anim_update, interval=cmdline.delay, blit=True)
+
+    # Print stats from a GUI timer rather than a thread, so it does not
+    # compete with plotting for the GIL
+    stats_timer = fig.canvas.new_timer(interval=2000)
+    stats_timer.add_callback(stats_updater(sensor))
+    stats_timer.start()
 
     tt = tune_table(sensor, args['cell_lines'], cmdline.patch)
     plt.show()
 
-    shutdown = True
+    stats_timer.stop()
     sensor.stop()
-    stats_thread.join()
 
 if __name__ == '__main__':
     main()